@@ -27,10 +27,12 @@ __released__ = '2024-12-14'
 
 
 # IMPORTS {{{1
-from docopt import docopt
 from inform import Error, fatal, full_stop, os_error
 from pathlib import Path
+import os
+import shutil
 from . import NTlog
+from .ntlog import BUFFER_SIZE
 
 # UTILITIES {{{1
 # to_int() {{{2
@@ -45,10 +47,14 @@ def to_int(number):
         fatal('could not convert to number.', culprit=number)
 
 # MAIN {{{1
-def main():
+def main(argv=None):
     # Command line {{{2
+    from docopt import docopt
+        # deferred to here to keep importing ntlog.main inexpensive
     editors = ', '.join(NTlog.MODE_LINES)
-    cmdline = docopt(__doc__.format(editors=editors), version=__version__)
+    cmdline = docopt(
+        __doc__.format(editors=editors), argv=argv, version=__version__
+    )
     input_logfile = Path(cmdline['<logfile>'])
     output_logfile = input_logfile.with_suffix('.log.nt')
     keep_for = cmdline['--keep-for']
@@ -66,13 +72,15 @@ def main():
         fold_marker_mapping = None
 
     # Load the running log, append the logfile, and write it out again {{{2
+    # the logfile is opened first so its modification time can be taken from
+    # the open file rather than by looking up the path a second time
     try:
-        with NTlog(
+        with input_logfile.open(buffering=BUFFER_SIZE) as log, NTlog(
             output_logfile,
             keep_for = keep_for,
             max_entries = max_entries,
             min_entries = min_entries,
-            ctime = input_logfile.stat().st_mtime,
+            ctime = os.fstat(log.fileno()).st_mtime,
             year_header = cmdline['--year'],
             month_header = cmdline['--month'],
             day_header = cmdline['--day'],
@@ -82,8 +90,8 @@ def main():
             description = cmdline['--description'],
             editor = cmdline['--editor'],
         ) as ntlog:
-            log = input_logfile.read_text()
-            ntlog.write(log)
+            # copy in blocks rather than reading the whole log into memory
+            shutil.copyfileobj(log, ntlog, BUFFER_SIZE)
 
         if delete_given_log:
             input_logfile.unlink()
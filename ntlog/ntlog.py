@@ -32,33 +32,162 @@ at NestedText file where the creation time is used as the key for the entries.
 
 # IMPORTS {{{1
 from inform import Error, error, is_str
-from quantiphy import Quantity, UnitConversion, QuantiPhyError
 import nestedtext as nt
 from pathlib import Path
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
+from locale import setlocale, LC_TIME
+from operator import itemgetter, ne
 import arrow
-import io
+import os
+import re
+import shutil
 
 
 # UTILITIES {{{1
 # Time Conversions {{{2
-UnitConversion("s", "sec second seconds")
-UnitConversion("s", "m min minute minutes", 60)
-UnitConversion("s", "h hr hour hours", 60*60)
-UnitConversion("s", "d day days", 24*60*60)
-UnitConversion("s", "w W week weeks", 7*24*60*60)
-UnitConversion("s", "M month months", 30*24*60*60)
-UnitConversion("s", "y Y year years", 365*24*60*60)
-
-# trim_dict() {{{2
-# Trim the dictionary such that it contains only the max_entries most
-# recently added items.
-def trim_dict(d, max_entries):
-    return dict(list(d.items())[:max_entries])
+TIME_UNITS = [
+    ("sec second seconds", 1),
+    ("m min minute minutes", 60),
+    ("h hr hour hours", 60*60),
+    ("d day days", 24*60*60),
+    ("w W week weeks", 7*24*60*60),
+    ("M month months", 30*24*60*60),
+    ("y Y year years", 365*24*60*60),
+]
+SECONDS_PER_UNIT = {
+    unit: scale for units, scale in TIME_UNITS for unit in units.split()
+}
+SECONDS_PER_UNIT.update({'s': 1, '': 24*60*60})
+    # days are assumed if no units are given
+DURATION = re.compile(r'\s*(\d+(?:\.\d*)?|\.\d+)\s*([a-zA-Z]*)\s*')
+
+# QuantiPhy is slow to import and is only needed to convert durations the
+# regular expression does not handle, so it is imported and the time units
+# defined on first use.
+@lru_cache(maxsize=None)
+def define_time_units():
+    from quantiphy import UnitConversion
+    for units, scale in TIME_UNITS:
+        UnitConversion("s", units, scale)
+
+# to_seconds() {{{2
+# Convert a duration given as a string, such as '7d', to seconds.
+def to_seconds(duration):
+    match = DURATION.fullmatch(duration)
+    if match:
+        number, units = match.groups()
+        if units in SECONDS_PER_UNIT:
+            return float(number) * SECONDS_PER_UNIT[units]
+
+    from quantiphy import Quantity, QuantiPhyError
+    define_time_units()
+    try:
+        return Quantity(duration, 'd', scale='s', ignore_sf=True)
+    except QuantiPhyError as e:
+        raise Error(e, culprit='--keep-for')
+
+# I/O buffer size {{{2
+BUFFER_SIZE = 1<<16
+
+# replacement_paths() {{{2
+# Returns the path of a file that is to be replaced and the path of the
+# temporary file that is written first and then moved over it.  Symbolic links
+# are followed so the link itself is not replaced.
+def replacement_paths(path):
+    path = Path(os.path.realpath(path))
+    return path, path.with_name(path.name + '.tmp')
+
+# replacement() {{{2
+# Open a temporary file that replaces the given file once it has been written
+# and closed, so the file is never left partially written.  The temporary file
+# is given the permissions and, where allowed, the owner of the file it
+# replaces before anything is written to it.  If writing fails, the temporary
+# file is removed and the original file is left untouched.
+# Creating the temporary file requires write permission on the directory.  If
+# that is lacking, the file itself is opened and overwritten in place, unless
+# in_place is false, in which case the PermissionError is raised.
+@contextmanager
+def replacement(path, mode, in_place=True, **kwargs):
+    path, temp = replacement_paths(path)
+    try:
+        status = os.stat(path)
+    except FileNotFoundError:
+        status = None
+    try:
+        f = open(temp, mode, buffering=BUFFER_SIZE, **kwargs)
+    except PermissionError:
+        if not in_place:
+            raise
+        with open(path, mode, buffering=BUFFER_SIZE, **kwargs) as f:
+            yield f
+        return
+    try:
+        with f:
+            if status:
+                try:
+                    os.fchown(f.fileno(), status.st_uid, status.st_gid)
+                except OSError:
+                    pass
+                        # only the superuser may give a file away
+                os.fchmod(f.fileno(), status.st_mode & 0o7777)
+            yield f
+        os.replace(temp, path)
+    except BaseException:
+        try:
+            os.unlink(temp)
+        except FileNotFoundError:
+            pass
+        raise
+
+# ISO 8601 date {{{2
+# The layout produced by datetime.isoformat() for an aware datetime.
+ISO_DATE = re.compile(
+    r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.\d{6})?[+-]\d\d:\d\d'
+)
+
+# strftime_format() {{{2
+# Translate an arrow format into the equivalent strftime format, which is
+# rendered in C rather than by arrow's Python-level formatter.  Returns None if
+# the format contains a token with no strftime equivalent.  Names are only
+# translated in the C locale, where they match those produced by arrow.
+ARROW_TOKENS = re.compile(
+    r"(\[(?:(?!\]).)*\]|YYY?Y?|MM?M?M?|Do|DD?D?D?|d?dd?d?|HH?|hh?|mm?|ss?"
+    r"|SS?S?S?S?S?|ZZ?Z?|a|A|X|x|W)"
+)
+STRFTIME_CODES = dict(
+    YYYY='%Y', YY='%y', MM='%m', DDDD='%j', DD='%d', HH='%H', hh='%I', mm='%M',
+    ss='%S',
+)
+STRFTIME_NAMES = dict(MMMM='%B', MMM='%b', dddd='%A', ddd='%a', A='%p')
+
+@lru_cache(maxsize=None)
+def strftime_format(format):
+    codes = STRFTIME_CODES
+    if setlocale(LC_TIME) in ('C', 'POSIX'):
+        codes = dict(codes, **STRFTIME_NAMES)
+    pieces = []
+    for i, piece in enumerate(ARROW_TOKENS.split(format)):
+        if i % 2 == 0:
+            pieces.append(piece.replace('%', '%%'))
+        elif piece.startswith('['):
+            pieces.append(piece[1:-1].replace('%', '%%'))
+        elif piece in codes:
+            pieces.append(codes[piece])
+        else:
+            return None
+    return ''.join(pieces)
 
 # comment() {{{2
 # Add comment leader if first non-white-space header is not a #.
 def create_header(date, format, description=None):
-    text = date.format(format)
+    strftime = strftime_format(format)
+    if strftime is None:
+        text = arrow.get(date).format(format)
+    else:
+        text = date.strftime(strftime)
     prefix = ''
     if description:
         text = f"{description} ― {text}"
@@ -66,20 +195,90 @@ def create_header(date, format, description=None):
         prefix = '# '
     return prefix + text
 
+# parse_date {{{3
+# Keys are written using the ISO 8601 format, which can be read quickly using
+# datetime.fromisoformat().  Fall back to arrow for anything else.  The results
+# are cached as the same keys are read each time the running log is opened.
+try:
+    fromisoformat = datetime.fromisoformat
+except AttributeError:
+    # datetime.fromisoformat() was added in Python 3.7, use arrow before that
+    def fromisoformat(date):
+        return arrow.get(date).datetime
+
+@lru_cache(maxsize=None)
+def parse_date(date):
+    try:
+        parsed = fromisoformat(date)
+    except ValueError:
+        return arrow.get(date).datetime
+    if parsed.tzinfo is None:
+        # like arrow, assume UTC if no offset is given
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
 # extract_key {{{3
 def extract_key(key):
     # split description from date, and convert to tuple
-    components = [c.strip() for c in key.split('―')]
-    if len(components) == 2:
-        description, date = components
-    elif len(components) == 1:
-        date = components[0]
-        description = None
-    return arrow.get(date), description
+    # descriptions never contain a horizontal bar, so split on the last one
+    description, _, date = key.rpartition('―')
+    return parse_date(date.strip()), description.strip() or None
+
+# sort_entries {{{3
+# Sort the entries newest first, returning (date, key, value) triples along
+# with oldest, converted so it can be compared against the dates.
+# ISO 8601 dates sort chronologically as strings if they all share the same UTC
+# offset and are laid out as isoformat() writes them, in which case the keys
+# themselves are used as the dates and are neither parsed nor compared as
+# dates.  Otherwise, such as when keys have descriptions, use another valid
+# layout, or a change to daylight saving time occurred, fall back to parsing
+# every key.
+# The running log is normally written newest first, and sorted() recognizes
+# such presorted input in a single linear pass, so no separate check is made.
+def sort_entries(entries, oldest):
+    offsets = {k[-6:] for k in entries}
+    if len(offsets) == 1 and all(map(ISO_DATE.fullmatch, entries)):
+        entries = [(k, k, v) for k, v in entries.items()]
+        tz = parse_date(entries[0][0]).tzinfo
+        oldest = oldest.astimezone(tz).isoformat()
+    else:
+        entries = [(extract_key(k)[0], k, v) for k, v in entries.items()]
+    entries.sort(key=itemgetter(0), reverse=True)
+    return entries, oldest
+
+# find_entry {{{3
+# Return the contents of the entry with the given key, or None if there is no
+# such entry.  Entries are sorted newest first, so the search stops at the
+# first entry that is older than the key.
+def find_entry(entries, key):
+    for k, text in entries:
+        if k == key:
+            return text
+        if k[0] < key[0]:
+            return None
+
+# dump_entries {{{3
+# Render each entry as NestedText.  Dumping all the entries at once is faster
+# than dumping them one at a time, and the result is easily split back into
+# entries as each begins with the only line of its rendering that is not
+# indented.  That requires that no key span lines, so otherwise, or if the
+# split does not produce one rendering per entry, dump them one at a time.
+def dump_entries(entries):
+    if len(entries) > 1 and not any('\n' in k for k, v in entries):
+        rendered = []
+        for line in nt.dumps(dict(entries)).split('\n'):
+            if line.startswith(' '):
+                rendered[-1].append(line)
+            else:
+                rendered.append([line])
+        if len(rendered) == len(entries):
+            return ['\n'.join(lines) for lines in rendered]
+    return [nt.dumps({k: v}) for k, v in entries]
 
 # encode_key {{{3
 def encode_key(date, description):
-    return f"{description} ― {date!s}" if description else str(date)
+    date = date.isoformat()
+    return f"{description} ― {date}" if description else date
 
 
 # NTlog class {{{1
@@ -89,6 +288,14 @@ class NTlog:
         vim = "# vim: set shiftwidth=4 softtabstop=4 expandtab nowrap foldmethod=marker:"
     )
 
+    __slots__ = (
+        'year_header', 'month_header', 'day_header', 'hour_header',
+        'entry_header', 'description', 'fold_marker_mapping', 'mode_line',
+        'running_log_file', 'running_log', 'dirty', 'ctime',
+        'log_parts', 'write',
+        'temp_log_file', 'temp_log', 'temp_log_written', 'delete_temp',
+    )
+
     # description {{{2
     """ NTlog
 
@@ -145,8 +352,9 @@ class NTlog:
         *NTlogError* is a clone of the Error_ exception from Inform_.
 
     The use of *temp_log_file* is optional.  It is helpful with long running 
-    processes as it provides a way of monitoring the progress of the process, 
-    especially if the logfile is routinely flushed.
+    processes as it provides a way of monitoring the progress of the process.
+    Text written to the log appears in the temporary log file when the log is 
+    flushed, so it should be routinely flushed.
 
     Example (no temp log with error reporting)::
 
@@ -234,7 +442,13 @@ class NTlog:
                 error('unknown editor.', culprit=editor)
 
         # preliminaries {{{3
-        self.log = io.StringIO()
+        self.log_parts = []
+        self.write = self.log_parts.append
+            # text is copied to the temporary log when the log is flushed or
+            # closed and fold markers are mapped when closed, so writing is
+            # just an append; binding write directly to the append method
+            # avoids a Python level call on every write
+        self.temp_log_written = 0
         if temp_log_file:
             temp_log_file = Path(temp_log_file)
             self.temp_log_file = temp_log_file
@@ -245,126 +459,217 @@ class NTlog:
         self.running_log_file = Path(running_log_file)
         self.ctime = ctime
         if is_str(keep_for):
-            try:
-                keep_for = Quantity(keep_for, 'd', scale='s', ignore_sf=True)
-            except QuantiPhyError as e:
-                raise Error(e, culprit='--keep-for')
+            keep_for = to_seconds(keep_for)
         if keep_for:
-            oldest = arrow.now().shift(seconds=-keep_for)
+            oldest = arrow.now().shift(seconds=-keep_for).datetime
         else:
-            oldest = arrow.get(0)
+            oldest = arrow.get(0).datetime
 
         # load running log {{{3
-        try:
-            running_log = nt.load(self.running_log_file, dict)
-        except FileNotFoundError:
-            running_log = {}
-
-        try:
-            running_log = {extract_key(k):v  for k,v in running_log.items()}
-        except arrow.ParserError as e:
-            raise Error(str(e).partition(' Try passing')[0], culprit=running_log_file)
-        running_log = {k:running_log[k] for k in sorted(running_log, reverse=True)}
-
-        # filter running log {{{3
-        if len(running_log) >= min_entries:
-            truncated_log = {k:v for k,v in running_log.items() if k[0] > oldest}
-            if len(truncated_log) < min_entries-1:
-                truncated_log = trim_dict(running_log, min_entries-1)
-            running_log = truncated_log
-        if max_entries and len(running_log) >= max_entries:
-            running_log = trim_dict(running_log, max_entries-1)
-
-        self.running_log = running_log
+        # the running log is loaded even if only the new entry is to be kept so
+        # that a file that is not a valid running log is reported rather than
+        # silently replaced
+        self.load(oldest, min_entries, max_entries)
 
         # open temporary log file {{{3
         if temp_log_file:
-            self.temp_log = self.temp_log_file.open('w')
+            self.temp_log = self.temp_log_file.open(
+                'w', encoding='utf-8', buffering=BUFFER_SIZE
+            )
             self.delete_temp = not retain_temp
         else:
             self.temp_log_file = None
 
-    # write() {{{2
-    def write(self, text):
-        if self.temp_log_file:
-            self.temp_log.write(text)
-        if self.fold_marker_mapping:
-            text = text.replace(*self.fold_marker_mapping)
-        self.log.write(text)
+    # load() {{{2
+    # Load the running log, keeping only the entries allowed by the limits.
+    def load(self, oldest, min_entries, max_entries):
+        # read running log {{{3
+        # nt.load() reads the file line by line, so use a large buffer to
+        # reduce the number of read calls needed for large running logs
+        try:
+            with open(
+                self.running_log_file, encoding='utf-8-sig', buffering=BUFFER_SIZE
+            ) as f:
+                running_log = nt.load(f, dict, source=str(self.running_log_file))
+        except FileNotFoundError:
+            running_log = {}
+
+        # filter running log {{{3
+        # walk the entries newest first, stopping at the first that is beyond
+        # the limits, and parse only the keys of those retained
+        try:
+            entries, oldest = sort_entries(running_log, oldest)
+            keep_old = len(entries) < min_entries
+            self.running_log = deque()
+            for date, k, v in entries:
+                i = len(self.running_log)
+                if max_entries and i >= max_entries-1:
+                    break
+                if date <= oldest and i >= min_entries-1 and not keep_old:
+                    break
+                key = extract_key(k)
+                if i and key == self.running_log[-1][0]:
+                    continue
+                    # same date as the previous key but written differently,
+                    # such as with Z rather than +00:00; both would be
+                    # written back with the same key, so keep only the first
+                self.running_log.append((key, v))
+            self.dirty = len(self.running_log) < len(entries) or any(
+                map(ne, (k for d, k, v in entries), running_log)
+            )
+                # running log must be rewritten if entries were dropped or
+                # they were out of order
+        except arrow.ParserError as e:
+            raise Error(
+                str(e).partition(' Try passing')[0], culprit=self.running_log_file
+            )
 
     # flush() {{{2
     def flush(self):
         if self.temp_log_file:
+            self.write_temp_log()
             self.temp_log.flush()
 
+    # write_temp_log() {{{2
+    # Copy the text written since the last flush to the temporary log.
+    def write_temp_log(self):
+        self.temp_log.write(''.join(self.log_parts[self.temp_log_written:]))
+        self.temp_log_written = len(self.log_parts)
+
     # close() {{{2
     def close(self):
-        # create new log entry and add it to running log {{{3
-        if self.ctime:
-            ctime = arrow.get(self.ctime).to('local')
-        else:
-            ctime = arrow.get().to('local')
-        contents = self.log.getvalue()
-        key = (ctime, self.description)
-        log = {key: contents}
+        try:
+            # create new log entry and add it to running log {{{3
+            if self.ctime:
+                ctime = arrow.get(self.ctime).to('local').datetime
+            else:
+                ctime = datetime.now().astimezone()
+                    # already local, no need to go through UTC and arrow
+            contents = ''.join(self.log_parts)
+            if self.fold_marker_mapping:
+                contents = contents.replace(*self.fold_marker_mapping)
+            key = (ctime, self.description)
+            log = self.running_log
+            prepend = False
+
+            existing = find_entry(self.running_log, key)
+            if existing is None:
+                # if the only change is the addition of a new newest entry, it
+                # can be prepended rather than writing the whole running log
+                # again
+                prepend = bool(log) and not self.dirty and ctime > log[0][0][0]
+                log.appendleft((key, contents))
+                self.dirty = True
+            elif contents != existing:
+                raise Error(
+                    'attempt to overwrite log entry.', culprit=encode_key(*key)
+                )
 
-        if key in self.running_log:
-            if contents != self.running_log[key]:
-                raise Error('attempt to overwrite log entry.', culprit=encode_key(*key))
-        log.update(self.running_log)
+            # write out running log {{{3
+            # skip if the running log is unchanged, as when rerunning on a log
+            # that was already incorporated
+            if self.dirty:
+                if not (prepend and self.prepend(log)):
+                    self.dump(log)
+        except BaseException:
+            # the temporary log is kept and so holds the only copy of any text
+            # that did not reach the running log
+            if self.temp_log_file:
+                self.write_temp_log()
+                self.temp_log.close()
+            raise
 
-        # write out running log {{{3
-        self.dump(log)
+        # close and remove temp_log {{{3
+        if self.temp_log_file:
+            if not self.delete_temp:
+                self.write_temp_log()
+            self.temp_log.close()
+            if self.delete_temp:
+                self.temp_log_file.unlink()
 
-    # dump() {{{2
-    def dump(self, log):
-        # write out running log {{{3
-        output = []
-        year = month = day = hour = None
-        for key, text in log.items():
+    # render() {{{2
+    # Generate the lines of the running log, less the mode line.
+    def render(self, log):
+        rendered = dump_entries([(encode_key(*key), text) for key, text in log])
+        formats = [
+            self.year_header, self.month_header, self.day_header, self.hour_header
+        ]
+        add_headers = any(formats)
+        last = None
+        for (key, text), entry in zip(log, rendered):
             date, description = key
 
-            # add year header if requested
-            if self.year_header and date.year != year:
-                output.append(create_header(date, self.year_header))
-                year = date.year
-                month = day = hour = None
-
-            # add month header if requested
-            if self.month_header and date.month != month:
-                output.append(create_header(date, self.month_header))
-                month = date.month
-                day = hour = None
-
-            # add day header if requested
-            if self.day_header and date.day != day:
-                output.append(create_header(date, self.day_header))
-                day = date.day
-                hour = None
-
-            # add hour header if requested
-            if self.hour_header and date.hour != hour:
-                output.append(create_header(date, self.hour_header))
-                hour = date.hour
+            # add year, month, day and hour headers if requested
+            # when the date first differs from that of the previous entry in a
+            # given field, headers for that field and the finer ones are added
+            if add_headers:
+                this = (date.year, date.month, date.day, date.hour)
+                if this != last:
+                    changed = 0
+                    if last:
+                        while this[changed] == last[changed]:
+                            changed += 1
+                    for format in formats[changed:]:
+                        if format:
+                            yield create_header(date, format)
+                    last = this
 
             # add entry header if requested
             if self.entry_header:
-                output.append(create_header(date, self.entry_header, description))
+                yield create_header(date, self.entry_header, description)
 
             # add entry
-            output.append(nt.dumps({encode_key(date, description): text}))
-            output.append('')
-
-        if self.mode_line:
-            output.append(self.mode_line)
-
-        self.running_log_file.write_text('\n'.join(output) + '\n')
+            yield entry
+            yield ''
 
-        # close and remove temp_log {{{3
-        if self.temp_log_file:
-            self.temp_log.close()
-            if self.delete_temp:
-                self.temp_log_file.unlink()
+    # dump() {{{2
+    # The running log is written to a temporary file that then replaces it,
+    # so it is never left partially written if the process is interrupted.
+    def dump(self, log):
+        # write the lines through a large buffer rather than joining them
+        # into one large string first
+        with replacement(self.running_log_file, 'w', encoding='utf-8') as f:
+            f.writelines(line + '\n' for line in self.render(log))
+            if self.mode_line:
+                f.write(self.mode_line + '\n')
+
+    # prepend() {{{2
+    # Add a new newest entry to the running log without rewriting the older
+    # entries.  The headers above an entry depend only on the entry that
+    # precedes it, so only the head of the file, up to the end of the entry
+    # that was previously the newest, is replaced.  The rest is copied as is.
+    # Returns False, leaving the file untouched, if the head or the mode line
+    # of the file are not what dump() would have written, or if the file cannot
+    # be replaced because its directory is not writable, in which case the
+    # whole running log must be dumped.
+    def prepend(self, log):
+        def encode(lines):
+            return ''.join(line + '\n' for line in lines).encode('utf-8')
+        new, previous = log[0], log[1]
+        old_head = encode(self.render([previous]))
+        new_head = encode(self.render([new, previous]))
+        end = encode([self.mode_line]) if self.mode_line else b'\n\n'
+
+        with open(self.running_log_file, 'rb', buffering=BUFFER_SIZE) as f:
+            if f.read(len(old_head)) != old_head:
+                return False
+            size = f.seek(0, os.SEEK_END)
+            if size < len(end):
+                return False
+            f.seek(size - len(end))
+            if f.read() != end:
+                return False
+            f.seek(len(old_head))
+            try:
+                with replacement(
+                    self.running_log_file, 'wb', in_place=False
+                ) as out:
+                    out.write(new_head)
+                    shutil.copyfileobj(f, out, BUFFER_SIZE)
+            except PermissionError:
+                return False
+                    # the file is being read, so it cannot be written in place
+        return True
 
     # __str__() {{{2
     def __str__(self):
@@ -0,0 +1,6 @@
+import pytest
+
+@pytest.fixture(autouse=True)
+def run_in_tmp_path(tmp_path, monkeypatch):
+    # each test works in its own directory so that tests can run in parallel
+    monkeypatch.chdir(tmp_path)
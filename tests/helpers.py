@@ -0,0 +1,21 @@
+# Utilities shared by the tests.
+from functools import lru_cache
+import arrow
+import os
+
+def rm(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def overwrite(path, text):
+    # truncating on open makes a preceding rm unnecessary
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, text.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+# the same keys are parsed repeatedly as the running log grows
+get_date = lru_cache(maxsize=4096)(arrow.get)
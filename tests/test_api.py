@@ -1,3 +1,4 @@
+from bisect import bisect_right
 from pathlib import Path
 from ntlog import NTlog, NTlogError
 from inform import Error, dedent
@@ -5,26 +6,36 @@ import nestedtext as nt
 import arrow
 import os
 import pytest
-
-def time_matches(found, expected, tolerance=5):
-    return (
-        found > expected.shift(seconds=-tolerance)
-        and
-        found < expected.shift(seconds=tolerance)
-    )
+from helpers import get_date, overwrite, rm
 
 def times_match(found, expected, tolerance=5):
-    return any(time_matches(f, e) for f in found for e in expected)
+    # returns True if any found time is within tolerance of an expected time
+    found = sorted(f.timestamp() for f in found)
+    expected = sorted(e.timestamp() for e in expected)
+    i = j = 0
+    while i < len(found) and j < len(expected):
+        if found[i] <= expected[j] - tolerance:
+            i += 1
+        elif found[i] >= expected[j] + tolerance:
+            j += 1
+        else:
+            return True
+    return False
 
-def find_key(expected, entries):
-    for key in entries:
-        if time_matches(key, expected):
-            return key
+def find_key(expected, timestamps, keys, tolerance=5):
+    # timestamps must be sorted and keys given in the same order
+    expected = expected.timestamp()
+    i = bisect_right(timestamps, expected - tolerance)
+    if i < len(timestamps) and timestamps[i] < expected + tolerance:
+        return keys[i]
 
 def exercise_ntlog(delete_running_log=True, extra="", **kwargs):
     assert 'ctime' not in kwargs
     if 'running_log_file' not in kwargs:
         kwargs['running_log_file'] = 'test.log.nt'
+    running_log_file = kwargs['running_log_file']
+    temp_log_file = kwargs.get('temp_log_file')
+    retain_temp = kwargs.get('retain_temp')
     keep_for = kwargs.get('keep_for', 7)
     min_entries = kwargs.get('min_entries', 1)
     max_entries = kwargs.get('max_entries', 0)
@@ -33,27 +44,28 @@ def exercise_ntlog(delete_running_log=True, extra="", **kwargs):
     if not max_entries:
         max_entries = 1000
     if delete_running_log:
-        Path('test.log.nt').unlink(missing_ok=True)
+        rm('test.log.nt')
 
     ctimes = []
-    for days in reversed(range(days_upper_bound + 7)):
-        now = arrow.now()
+    now = arrow.now()
+    for days in range(days_upper_bound + 6, -1, -1):
         ctime = now.shift(days=-days)
         ctimes.append(ctime)
         ctime_to_use = ctime if days else None
-        temp_log_file = kwargs.get('temp_log_file')
-        retain_temp = kwargs.get('retain_temp')
 
         # run ntlog and retrieve the results
         with NTlog(ctime=ctime_to_use, **kwargs) as ntlog:
             ntlog.write(f"entry written = {days} days ago.{extra}")
             if temp_log_file:
                 assert os.path.isfile(temp_log_file)
-        running_log = nt.load(kwargs['running_log_file'])
-        running_log = {arrow.get(k): v for k, v in running_log.items()}
+        running_log = nt.load(running_log_file)
+        dated = sorted((get_date(k).timestamp(), k) for k in running_log)
+        timestamps = [t for t, k in dated]
+        keys = [k for t, k in dated]
+            # running log stays keyed by string; find_key() returns those keys
 
         # running log must contain the given log entry
-        assert find_key(ctime, running_log)
+        assert find_key(ctime, timestamps, keys)
 
         # check to see if given temp log was created if requested
         if temp_log_file:
@@ -68,7 +80,7 @@ def exercise_ntlog(delete_running_log=True, extra="", **kwargs):
         ctimes_to_check = ctimes[-num_entries:]
         for ctime in ctimes_to_check:
             age = (now - ctime).days
-            key = find_key(ctime, running_log)
+            key = find_key(ctime, timestamps, keys)
             assert key, str(ctime)
             assert running_log[key] == f"entry written = {age} days ago."
 
@@ -84,7 +96,7 @@ def test_defaults():
     with NTlog('test.log.nt', keep_for='3d'):
         pass
     running_log = nt.load('test.log.nt')
-    ctimes = [arrow.get(k) for k in running_log.keys()]
+    ctimes = [get_date(k) for k in running_log.keys()]
     # trim off last update and reverse order
     ctimes = list(reversed(ctimes[1:]))
     assert len(ctimes) == len(expected_ctimes)
@@ -103,10 +115,11 @@ def test_min_entries():
 
 def test_max_entries():
     exercise_ntlog(max_entries=3)
+    exercise_ntlog(max_entries=1)
 
 def test_retention():
     # checks that you can add a given log file that is beyond the keep_for date
-    Path('test.log.nt').unlink(missing_ok=True)
+    rm('test.log.nt')
     for i in range(5):
         age = 21 + i
         ctime = arrow.now().shift(days=-age)
@@ -118,12 +131,131 @@ def test_retention():
         assert len(ctimes) == 1
         assert ctimes[0] == str(ctime)
 
+def test_unchanged():
+    # checks that the running log is not rewritten if it would be unchanged
+    running_logfile = Path('test.log.nt')
+    rm(running_logfile)
+    ctime = arrow.now().shift(days=-1)
+    for i in range(3):
+        with NTlog(running_logfile, ctime=ctime) as ntlog:
+            ntlog.write("Hey now!")
+        if i:
+            assert running_logfile.stat().st_mtime == 0
+        else:
+            os.utime(running_logfile, (0, 0))
+    assert nt.load(running_logfile) == {str(ctime): "Hey now!"}
+
+def test_permissions():
+    # checks that replacing the running log preserves its permissions
+    running_logfile = Path('test.log.nt')
+    rm(running_logfile)
+    now = arrow.now()
+    with NTlog(running_logfile, ctime=now.shift(days=-2)) as ntlog:
+        ntlog.write("Hey now!")
+    running_logfile.chmod(0o600)
+
+    # adding a new newest entry prepends it to the running log
+    with NTlog(running_logfile, ctime=now.shift(days=-1)) as ntlog:
+        ntlog.write("Hey there!")
+    assert running_logfile.stat().st_mode & 0o777 == 0o600
+    assert len(nt.load(running_logfile)) == 2
+    assert not Path('test.log.nt.tmp').exists()
+
+    # dropping an old entry requires that the whole running log be dumped
+    with NTlog(running_logfile, ctime=now, max_entries=2) as ntlog:
+        ntlog.write("Hey you!")
+    assert running_logfile.stat().st_mode & 0o777 == 0o600
+    assert len(nt.load(running_logfile)) == 2
+    assert not Path('test.log.nt.tmp').exists()
+
+@pytest.mark.skipif(
+    os.geteuid() == 0, reason="the superuser may write any directory"
+)
+def test_read_only_directory():
+    # checks that the running log is written in place if its directory is not
+    # writable
+    running_logfile = Path('test.log.nt')
+    rm(running_logfile)
+    now = arrow.now()
+    with NTlog(running_logfile, ctime=now.shift(days=-2)) as ntlog:
+        ntlog.write("Hey now!")
+    os.chmod('.', 0o555)
+    try:
+        # first prepend a new entry, then drop the oldest entry
+        with NTlog(running_logfile, ctime=now.shift(days=-1)) as ntlog:
+            ntlog.write("Hey there!")
+        with NTlog(running_logfile, ctime=now, max_entries=2) as ntlog:
+            ntlog.write("Hey you!")
+    finally:
+        os.chmod('.', 0o755)
+    running_log = nt.load(running_logfile)
+    assert list(running_log.values()) == ["Hey you!", "Hey there!"]
+
+def test_headers():
+    # checks that headers are added above the appropriate entries
+    running_logfile = Path('test.log.nt')
+    rm(running_logfile)
+    ctimes = [
+        arrow.get(2023, 12, 31, 22, 15, tzinfo='local'),
+        arrow.get(2023, 12, 31, 23, 45, tzinfo='local'),
+        arrow.get(2024, 1, 1, 8, 30, tzinfo='local'),
+    ]
+    for i, ctime in enumerate(ctimes):
+        with NTlog(
+            running_logfile, ctime=ctime,
+            year_header = 'YYYY',
+            month_header = 'MMMM YYYY',
+            day_header = 'dddd, D MMMM',
+            hour_header = '## h A',
+            entry_header = 'HH:mm',
+            description = f'run {i}',
+            editor = 'vim',
+        ) as ntlog:
+            ntlog.write(f"entry {i}")
+    assert running_logfile.read_text() == dedent(f"""
+        # 2024
+        # January 2024
+        # Monday, 1 January
+        ## 8 AM
+        # run 2 ― 08:30
+        run 2 ― {ctimes[2]!s}: entry 2
+
+        # 2023
+        # December 2023
+        # Sunday, 31 December
+        ## 11 PM
+        # run 1 ― 23:45
+        run 1 ― {ctimes[1]!s}: entry 1
+
+        ## 10 PM
+        # run 0 ― 22:15
+        run 0 ― {ctimes[0]!s}: entry 0
+
+        {NTlog.MODE_LINES['vim']}
+    """, strip_nl='l')
+
+def test_month_headers():
+    # checks that month headers are added when only the year changes, even
+    # when year headers are not requested
+    running_logfile = Path('test.log.nt')
+    rm(running_logfile)
+    for year in [2023, 2024]:
+        with NTlog(
+            running_logfile, month_header='MMMM YYYY',
+            ctime=arrow.get(year, 1, 15, tzinfo='local'),
+        ) as ntlog:
+            ntlog.write(f"entry {year}")
+    lines = running_logfile.read_text().splitlines()
+    assert [l for l in lines if l.startswith('#')] == [
+        '# January 2024', '# January 2023'
+    ]
+
 def test_flush():
     # checks that you can add a given log file that is beyond the keep_for date
     running_log_file = Path('test.log.nt')
     temp_log_file = Path('test.log')
-    running_log_file.unlink(missing_ok=True)
-    temp_log_file.unlink(missing_ok=True)
+    rm(running_log_file)
+    rm(temp_log_file)
     with NTlog(running_log_file, temp_log_file, retain_temp=False) as ntlog:
             ntlog.write("Hey now!")
             ntlog.flush()
@@ -131,24 +263,112 @@ def test_flush():
             assert contents == "Hey now!"
     assert not temp_log_file.is_file()
 
+def test_offsets():
+    # checks that entries are ordered and filtered correctly when their
+    # datestamps use differing UTC offsets
+    running_logfile = Path('test.log.nt')
+    now = arrow.now()
+    ctimes = [
+        now.shift(days=-1).to('+05:00'),
+        now.shift(days=-2).to('-08:00'),
+        now.shift(days=-3).to('+00:00'),
+        now.shift(days=-9).to('+05:00'),
+    ]
+    for same_offset in [False, True]:
+        running_log = {str(c): f"entry {i}" for i, c in enumerate(ctimes)}
+        if same_offset:
+            running_log = {str(c.to('+05:00')): v for c, v in zip(ctimes, running_log.values())}
+        nt.dump(dict(reversed(running_log.items())), running_logfile)
+        with NTlog(running_logfile, keep_for='7d', ctime=now):
+            pass
+        running_log = nt.load(running_logfile)
+        keys = list(running_log)
+        assert keys[0] == str(now)
+        assert [get_date(k) for k in keys[1:]] == ctimes[:3]
+        assert list(running_log.values())[1:] == ["entry 0", "entry 1", "entry 2"]
+
+    # ISO 8601 also allows a space to separate the date and time, such keys
+    # sort below those that use a T when compared as strings
+    newer = now.shift(hours=-1).to('+00:00')
+    older = now.shift(hours=-2).to('+00:00')
+    running_log = {str(newer).replace('T', ' '): "newer", str(older): "older"}
+    nt.dump(running_log, running_logfile)
+    with NTlog(running_logfile, keep_for='90m', ctime=now):
+        pass
+    running_log = nt.load(running_logfile)
+    assert list(running_log) == [str(now), str(newer)]
+    assert list(running_log.values())[1:] == ["newer"]
+
+def test_duplicate_dates():
+    # checks that keys giving the same date in different ways are merged, as
+    # they would otherwise be written back as duplicate keys
+    running_logfile = Path('test.log.nt')
+    now = arrow.now()
+    ctime = now.shift(days=-1).to('UTC')
+    date = ctime.format('YYYY-MM-DDTHH:mm:ss.SSSSSS')
+    running_log = {f"{date}Z": "entry", f"{date}+00:00": "entry"}
+    nt.dump(running_log, running_logfile)
+    with NTlog(running_logfile, ctime=now):
+        pass
+    running_log = nt.load(running_logfile)
+    assert list(running_log) == [str(now), str(ctime)]
+    assert list(running_log.values())[1:] == ["entry"]
+
+def test_fold_markers():
+    # checks that fold markers are mapped in the running log, even if split
+    # between writes, but not in the temporary log
+    running_log_file = Path('test.log.nt')
+    temp_log_file = Path('test.log')
+    rm(running_log_file)
+    ctime = arrow.now()
+    with NTlog(
+        running_log_file, temp_log_file, retain_temp=True, ctime=ctime,
+        fold_marker_mapping=['{{{', '<<<'],
+    ) as ntlog:
+        ntlog.write("Hey {{{1\n")
+        ntlog.write("now! {{")
+        ntlog.write("{2\n")
+    assert nt.load(running_log_file) == {str(ctime): "Hey <<<1\nnow! <<<2\n"}
+    assert temp_log_file.read_text() == "Hey {{{1\nnow! {{{2\n"
+
+def test_temp_log_on_error():
+    # checks that the temporary log is kept and holds all text written if the
+    # entry cannot be added to the running log
+    running_logfile = Path('test.log.nt')
+    temp_logfile = Path('test.log')
+    rm(running_logfile)
+    ctime = arrow.now().timestamp()
+    with NTlog(running_logfile, ctime=ctime) as ntlog:
+        ntlog.write('Hey now!')
+    for retain_temp in [True, False]:
+        rm(temp_logfile)
+        with pytest.raises(NTlogError):
+            with NTlog(
+                running_logfile, temp_logfile, ctime=ctime, retain_temp=retain_temp
+            ) as ntlog:
+                ntlog.write('important output\n')
+        assert temp_logfile.read_text() == 'important output\n'
+
 def test_exceptions():
     running_logfile = Path('test.log.nt')
 
     # try to save a log file with same ctime but differing contents
-    running_logfile.unlink(missing_ok=True)
+    rm(running_logfile)
     now = arrow.now()
     ctime = now.timestamp()
+    expected = "attempt to overwrite log entry."
+    expected_msg = f"{now!s}: {expected}"
     with pytest.raises(NTlogError) as exception:
         with NTlog(running_logfile, ctime=ctime) as ntlog:
             ntlog.write('Hey now!')
         with NTlog(running_logfile, ctime=ctime) as ntlog:
             ntlog.write('Hey there!')
     assert isinstance(exception.value, Error)
-    assert str(exception.value) == f"{now!s}: attempt to overwrite log entry."
-    assert exception.value.args == ('attempt to overwrite log entry.',)
+    assert str(exception.value) == expected_msg
+    assert exception.value.args == (expected,)
 
     # attempt to read a running log file with a bogus datestamp
-    running_logfile.write_text("not a date: contents")
+    overwrite(running_logfile, "not a date: contents")
     with pytest.raises(NTlogError) as exception:
         with NTlog(running_logfile, ctime=ctime):
             pass
@@ -158,7 +378,12 @@ def test_exceptions():
     assert exception.value.args == (expected,)
 
     # attempt to read a running log file that is not valid NestedText
-    running_logfile.write_text("not valid NestedText")
+    overwrite(running_logfile, "not valid NestedText")
+    with pytest.raises(NTlogError) as exception:
+        with NTlog('test.log.nt', ctime=ctime, max_entries=1) as ntlog:
+            pass
+    assert str(exception.value).startswith("test.log.nt, 1: unrecognized line.")
+    assert running_logfile.read_text() == "not valid NestedText"
     with pytest.raises(NTlogError) as exception:
         with NTlog('test.log.nt', ctime=ctime) as ntlog:
             pass
@@ -1,26 +1,33 @@
 from pathlib import Path
 from shlib import Run
+from ntlog.main import main
 import nestedtext as nt
 import arrow
 import os
+import pytest
+from helpers import get_date, overwrite, rm
 
-now = arrow.now()
+@pytest.fixture
+def now():
+    return arrow.now()
 
-def create_logfile(age, extra=''):
-    path = Path('test.log')
-    path.write_text(f"entry written = {age} days ago.{extra}")
+def create_logfile(now, age, extra='', path='test.log'):
+    with open(path, 'w') as f:
+        f.write(f"entry written = {age} days ago.{extra}")
     ctime = now.shift(days=-age, seconds=-600)
-    os.utime(str(path), (ctime.timestamp(), ctime.timestamp()))
+    timestamp = ctime.timestamp()
+    os.utime(path, (timestamp, timestamp))
     return ctime
 
 def exercise_ntlog(
+    now,
     keep_for = None,
     min_entries = None,
     max_entries = None,
     delete = None,
     delete_running_log = True
 ):
-    cmd = ['ntlog']
+    cmd = []
     if keep_for:
         cmd.extend(['--keep-for', str(keep_for)])
     if min_entries:
@@ -37,13 +44,13 @@ def exercise_ntlog(
     if not max_entries:
         max_entries = 1000
     if delete_running_log:
-        Path('test.log.nt').unlink(missing_ok=True)
+        rm('test.log.nt')
 
     ctimes = []
-    for days in reversed(range(upper_bound + 7)):
-        ctime = create_logfile(days)
+    for days in range(upper_bound + 6, -1, -1):
+        ctime = create_logfile(now, days)
         ctimes.append(ctime)
-        Run(cmd, 'sOEW')
+        main(cmd)
         running_log = nt.load('test.log.nt')
 
         # running log must contain the given log entry
@@ -61,84 +68,93 @@ def exercise_ntlog(
         ctimes_to_check = ctimes[-num_entries:]
         for ctime in ctimes_to_check:
             age = (now - ctime).days
+                # ctime shares the tzinfo of now, so this counts calendar days
+                # as create_logfile() does, even across daylight saving changes
             ctime = str(ctime)
             assert ctime in running_log, ctime
             assert running_log[ctime] == f"entry written = {age} days ago."
 
-def test_defaults():
-    exercise_ntlog()
+def test_defaults(now):
+    exercise_ntlog(now)
 
     # now shrink keep_for and check that old entries are deleted
     running_log = nt.load('test.log.nt')
-    ctimes = [arrow.get(k) for k in running_log]
-    expected_ctimes = [ctime for ctime in ctimes if (now - ctime).days < 3]
+    ctimes = [get_date(k) for k in running_log]
+    now_ts = now.timestamp()
+    expected_ctimes = [
+        ctime for ctime in ctimes if now_ts - ctime.timestamp() < 3*86400
+    ]
 
-    Run(['ntlog', '--keep-for', '3', 'test.log'], 'sOEW')
+    main(['--keep-for', '3', 'test.log'])
     running_log = nt.load('test.log.nt')
-    ctimes = [arrow.get(k) for k in running_log.keys()]
+    ctimes = [get_date(k) for k in running_log.keys()]
     assert len(ctimes) == len(expected_ctimes)
     assert ctimes == expected_ctimes
 
-def test_delete():
-    exercise_ntlog(delete=True)
+def test_delete(now):
+    exercise_ntlog(now, delete=True)
 
-def test_keep_for():
-    exercise_ntlog(keep_for=3)
+def test_keep_for(now):
+    exercise_ntlog(now, keep_for=3)
 
-def test_min_entries():
-    exercise_ntlog(min_entries=3)
+def test_min_entries(now):
+    exercise_ntlog(now, min_entries=3)
 
-def test_max_entries():
-    exercise_ntlog(max_entries=3)
+def test_max_entries(now):
+    exercise_ntlog(now, max_entries=3)
 
-def test_retention():
+def test_retention(now):
     # checks that you can add a given log file that is beyond the keep_for date
-    ctime = create_logfile(21)
-    Path('test.log.nt').unlink(missing_ok=True)
-    for i in range(5):
-        Run(['ntlog', 'test.log'], 'sOEW')
+    # and that adding it again is idempotent; every run after the first is
+    # identical, so the second run suffices
+    ctime = create_logfile(now, 21)
+    rm('test.log.nt')
+    for i in range(2):
+        main(['test.log'])
         running_log = nt.load('test.log.nt')
         ctimes = list(running_log.keys())
         assert len(ctimes) == 1
         assert ctimes[0] == str(ctime)
 
-def test_exceptions():
+def test_exceptions(now):
+    # ntlog is run as a separate process here so that its exit status and
+    # error messages can be checked
     running_logfile = Path('test.log.nt')
 
-    running_logfile.unlink(missing_ok=True)
+    rm(running_logfile)
     ntlog = Run(['ntlog', 'does-not-exist'], 'sOEW1')
     assert ntlog.status == 1
     assert ntlog.stderr == 'ntlog error: does-not-exist: no such file or directory.\n'
 
-    running_logfile.unlink(missing_ok=True)
+    rm(running_logfile)
     ntlog = Run(['ntlog', '--max-entries', 'infinity', 'does-not-exist'], 'sOEW1')
     assert ntlog.status == 1
     assert ntlog.stderr == 'ntlog error: infinity: could not convert to number.\n'
 
-    running_logfile.unlink(missing_ok=True)
+    rm(running_logfile)
     ntlog = Run(['ntlog', '--min-entries', '0', 'does-not-exist'], 'sOEW1')
     assert ntlog.status == 1
     assert ntlog.stderr == 'ntlog error: 0: expected strictly positive number.\n'
 
     # try to save a log file with same ctime but differing contents
-    running_logfile.unlink(missing_ok=True)
-    create_logfile(1)
+    rm(running_logfile)
+    create_logfile(now, 1)
     ntlog = Run(['ntlog', 'test.log'], 'sOEW1')
     assert ntlog.status == 0
-    ctime = create_logfile(1, extra='\na difference')
+    ctime = create_logfile(now, 1, extra='\na difference')
     ntlog = Run(['ntlog', 'test.log'], 'sOEW1')
     assert ntlog.status == 1
     #assert re.match('ntlog error: [^ ]+: attempt to overwrite log entry.\n', ntlog.stderr)
     assert ntlog.stderr == f'ntlog error: {ctime!s}: attempt to overwrite log entry.\n'
 
     # attempt to read a running log file with a bogus datestamp
-    path = running_logfile.write_text("not a date: contents")
+    overwrite(running_logfile, "not a date: contents")
     ntlog = Run(['ntlog', 'test.log'], 'sOEW1')
     assert ntlog.status == 1
     assert "Expected an ISO 8601-like string, but was given 'not a date'." in ntlog.stderr
 
     # attempt to read a bogus running log file
-    running_logfile.write_text("not a valid NT file")
+    overwrite(running_logfile, "not a valid NT file")
     ntlog = Run(['ntlog', 'test.log'], 'sOEW1')
     assert ntlog.status == 1
     assert 'unrecognized line.' in ntlog.stderr
@@ -158,4 +174,4 @@ if __name__ == '__main__':
             print()
             print('Calling:', k)
             print((len(k)+9)*'=')
-            v()
+            v(arrow.now())